@@ -8,9 +8,18 @@
 import uuid
 import sqlite3
 import csv
+import re
 
 import os
+import errno
+import shutil
 import hashlib
+import itertools
+import mmap
+import operator
+import collections
+import concurrent.futures
+import threading
 import time
 
 ################################################################################
@@ -23,6 +32,11 @@ import time
 class BaseInputDatabase:
     POSSIBLE_COLUMNS = set(['size', 'sha1', 'md5'])
     OPTIMAL_COLUMN_ORDER = ['size', 'sha1', 'md5']
+    COLUMN_SQL = {
+        'size': 'size INT NOT NULL',
+        'sha1': 'sha1 BLOB NOT NULL',
+        'md5': 'md5 BLOB NOT NULL',
+    }
 
     ################################################################################
     # validate_column_list - quickly check we don't have an invalid column setup
@@ -101,37 +115,94 @@ class BaseInputDatabase:
     def columns_with_type(self, columns_override=None):
         columns = self.ordered_column_subset(columns_override)
         BaseInputDatabase.validate_column_list(columns)
-        tr = []
-        for i in columns:
-            if i == 'size':
-                tr += ['size INT NOT NULL']
-            elif i == 'md5':
-                tr += ['md5 BLOB NOT NULL']
-            elif i == 'sha1':
-                tr += ['sha1 BLOB NOT NULL']
-            else:
-                raise ValueError(f"Could not process column {i}")
-        return tr
+        return [BaseInputDatabase.COLUMN_SQL[i] for i in columns]
 
     ################################################################################
     # file_infos - VIRTUAL
     #   This property shall be a generator that generates objects.  The generated
-    #   objects need to support the function:
+    #   objects need to have the attributes
     #
-    #   get_column(self, column_name)
+    #   size, sha1, md5
+    #
+    #   already holding the final column values for each column name returned by
+    #   'available_columns', and to support the function:
     #
-    #   For each column name returned by 'available_columns'
+    #   get_column(self, column_name)
     ################################################################################
     @property
     def file_infos(self):
         raise NotImplementedError
 
+    ################################################################################
+    # sqlite_source - OPTIONAL
+    #   Input databases that are themselves SQLite may return a tuple
+    #
+    #   (db_path, select_statement)
+    #
+    #   where select_statement reads the given ordered columns from the database
+    #   attached as 'src'.  fill_files_table will then let SQLite copy the rows
+    #   directly rather than going through file_infos.  Return None to use
+    #   file_infos.
+    ################################################################################
+    def sqlite_source(self, column_names):
+        return None
+
+################################################################################
+# HASH_CONSTRUCTORS
+#   The hash implementations used when hashing files.  hashlib is backed by
+#   OpenSSL, which already selects SHA-NI/AVX2 code at runtime where the CPU
+#   has it.  Any replacement must provide the same update()/digest() API.
+################################################################################
+HASH_CONSTRUCTORS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+}
+
+################################################################################
+# get_hash_read_buffer
+#   Reusable read buffer for hashing files that are not mmapped.  Files are
+#   hashed on several threads, so each thread gets its own buffer.
+################################################################################
+HASH_READ_BUFFER_SIZE = 1 << 20
+_hash_read_buffers = threading.local()
+
+def get_hash_read_buffer():
+    if not hasattr(_hash_read_buffers, 'buffer'):
+        _hash_read_buffers.buffer = bytearray(HASH_READ_BUFFER_SIZE)
+        _hash_read_buffers.view = memoryview(_hash_read_buffers.buffer)
+    return _hash_read_buffers.buffer, _hash_read_buffers.view
+
+################################################################################
+# scan_files
+#   Recursively yields os.DirEntry objects for the non-directory entries under
+#   folder.  Like os.walk, symlinked directories are not followed and
+#   directories that cannot be listed are skipped, but no path joining or
+#   second stat is needed per entry.
+################################################################################
+def scan_files(folder):
+    pending = [folder]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                else:
+                    yield entry
+
 ################################################################################
 # FolderAsInputDatabase
 #   A simple subclass of BaseInputDatabase that recursively walks a given
 #   directory and provides rows for the files in it.
 ################################################################################
 class FolderAsInputDatabase(BaseInputDatabase):
+    # Files at least this big are hashed through an mmap rather than read() into
+    # a bytes object.
+    MMAP_THRESHOLD = 10 * 1024 * 1024
 
     ################################################################################
     # __init__
@@ -142,6 +213,9 @@ class FolderAsInputDatabase(BaseInputDatabase):
         super().__init__()
         self._folder = folder
         self._columns = set(columns)
+        # Worked out once here rather than for every file hashed.
+        self._hash_constructors = FolderAsInputDatabase.FileInfo.hash_constructors_for(
+            self._columns)
 
     ################################################################################
     # available_columns
@@ -154,28 +228,99 @@ class FolderAsInputDatabase(BaseInputDatabase):
 
     ################################################################################
     # FileInfo
-    #   This class's file_infos generated objects.
+    #   This class's file_infos generated objects.  The file is opened and read
+    #   once by load(), and every requested hash is computed from that single
+    #   read.
     ################################################################################
     class FileInfo:
-        def __init__(self, filename):
+        def __init__(self, filename, columns, hash_constructors=None):
             self.filename = filename
+            self._columns = columns
+            if hash_constructors is None:
+                hash_constructors = self.hash_constructors_for(columns)
+            self._hash_constructors = hash_constructors
+            self._loaded = False
+            self.size = None
+            self.sha1 = None
+            self.md5 = None
+
+        @staticmethod
+        def hash_constructors_for(columns):
+            return tuple((name, HASH_CONSTRUCTORS[name])
+                         for name in BaseInputDatabase.OPTIMAL_COLUMN_ORDER
+                         if name in columns and name in HASH_CONSTRUCTORS)
+
+        def load(self):
+            if self._loaded:
+                return
+            hashers = tuple(new() for _, new in self._hash_constructors)
+
+            with open(self.filename, 'rb') as fh:
+                size = os.fstat(fh.fileno()).st_size
+                mapped = None
+                if size >= FolderAsInputDatabase.MMAP_THRESHOLD:
+                    try:
+                        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    except OSError:
+                        mapped = None
+                if mapped is not None:
+                    with mapped:
+                        # Hashing reads the mapping front to back exactly once.
+                        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                            mapped.madvise(mmap.MADV_SEQUENTIAL)
+                        for h in hashers:
+                            h.update(mapped)
+                else:
+                    # Smaller files, or ones that could not be mapped, are streamed
+                    # through one reused buffer so memory use stays flat.
+                    buffer, view = get_hash_read_buffer()
+                    while True:
+                        n = fh.readinto(buffer)
+                        if n == 0:
+                            break
+                        chunk = view[:n]
+                        for h in hashers:
+                            h.update(chunk)
+
+            if 'size' in self._columns:
+                self.size = size
+            for (name, _), h in zip(self._hash_constructors, hashers):
+                setattr(self, name, h.digest())
+            self._loaded = True
+
         def get_column(self, column_name):
-            if column_name == 'size':
-                return os.path.getsize(self.filename)
-            if column_name == 'md5':
-                return hashlib.md5(open(self.filename, 'rb').read()).digest()
-            if column_name == 'sha1':
-                return hashlib.sha1(open(self.filename, 'rb').read()).digest()
-            raise ValueError(f"Column `{column_name}` not supported")
+            if column_name not in self._columns:
+                raise ValueError(f"Column `{column_name}` not supported")
+            self.load()
+            return getattr(self, column_name)
+
+    ################################################################################
+    # _hash_one
+    #   Runs on a worker thread.  hashlib releases the GIL while hashing, so
+    #   several files really are hashed at once.
+    ################################################################################
+    def _hash_one(self, filename):
+        info = self.FileInfo(filename, self._columns, self._hash_constructors)
+        info.load()
+        return info
 
     ################################################################################
     # file_infos
+    #   Files are hashed on a thread pool.  At most 2 * workers files are in
+    #   flight, so memory stays bounded however big the tree is.
     ################################################################################
     @property
     def file_infos(self):
-        for item in os.walk(self._folder):
-            for filename in item[2]:
-                yield self.FileInfo(os.path.join(item[0], filename))
+        workers = os.cpu_count() or 1
+        filenames = (entry.path for entry in scan_files(self._folder))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for filename in filenames:
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(self._hash_one, filename))
+            while pending:
+                yield pending.popleft().result()
 
 ################################################################################
 # HashListAsInput
@@ -207,39 +352,55 @@ class HashListAsInputDatabase(BaseInputDatabase):
     ################################################################################
     class FileInfo:
         def __init__(self, column, line):
-            self._line = line.strip()
+            line = line.strip()
             self._column = column
+            self.size = None
+            self.sha1 = None
+            self.md5 = None
+            if column == 'size':
+                self.size = int(line)
+            elif column == 'md5':
+                if len(line) != 32:
+                    raise ValueError(f"String '{line}' is not 32 characters long")
+                self.md5 = bytes.fromhex(line)
+            elif column == 'sha1':
+                if len(line) != 40:
+                    raise ValueError(f"String '{line}' is not 40 characters long ")
+                self.sha1 = bytes.fromhex(line)
 
         def get_column(self, column_name):
             assert column_name == self._column, "Asked for invalid column"
-            if column_name == 'size':
-                return int(self._line)
-            elif column_name == 'md5':
-                if len(self._line) != 32:
-                    raise ValueError(f"String '{self._line}' is not 32 characters long")
-            elif column_name == 'sha1':
-                if len(self._line) != 40:
-                    raise ValueError(f"String '{self._line}' is not 40 characters long ")
-
-            return bytes.fromhex(self._line)
+            return getattr(self, column_name)
 
     ################################################################################
     # file_infos
+    #   The file is read in READ_BLOCK_SIZE blocks and split into lines, rather
+    #   than calling readline() once per hash.
     ################################################################################
+    READ_BLOCK_SIZE = 4 << 20
+
     @property
     def file_infos(self):
         with open(self._filename, 'r') as f:
+            carry = ''
             while True:
-                line = f.readline()
-                if len(line) == 0:
-                    return
-                yield self.FileInfo(self._column, line)
+                block = f.read(self.READ_BLOCK_SIZE)
+                if len(block) == 0:
+                    break
+                lines = (carry + block).split('\n')
+                # The last piece may be a partial line, finished by the next block
+                carry = lines.pop()
+                for line in lines:
+                    yield self.FileInfo(self._column, line)
+            if len(carry) > 0:
+                yield self.FileInfo(self._column, carry)
 
 ################################################################################
 # NsrlRdsInputDatabase
 #   Import a National Software Reference Library database of files.
 ################################################################################
 class NsrlRdsInputDatabase(BaseInputDatabase):
+    FETCH_BATCH_SIZE = 10000
 
     ################################################################################
     # __init__
@@ -279,21 +440,32 @@ class NsrlRdsInputDatabase(BaseInputDatabase):
     def available_columns(self):
         return set(['size', 'md5', 'sha1'])
 
+    ################################################################################
+    # sqlite_source
+    #   The NSRL hashes are hex text, so the copy needs unhex(), which SQLite only
+    #   has from 3.41.0 on.  Older SQLite falls back to file_infos.
+    ################################################################################
+    SQL_COLUMNS = {'size': 'file_size', 'sha1': 'unhex(sha1)', 'md5': 'unhex(md5)'}
+
+    def sqlite_source(self, column_names):
+        if sqlite3.sqlite_version_info < (3, 41, 0):
+            return None
+        cols = ', '.join(self.SQL_COLUMNS[a] for a in column_names)
+        return self._db_path, f"SELECT DISTINCT {cols} FROM src.FILE"
+
     ################################################################################
     # FileInfo
     #   This class's file_infos generated objects.
     ################################################################################
     class FileInfo:
         def __init__(self, line):
-            self._line = line
+            self.size = line[0]
+            self.sha1 = bytes.fromhex(line[1])
+            self.md5 = bytes.fromhex(line[2])
         def get_column(self, column_name):
-            if column_name == 'size':
-                return self._line[0]
-            if column_name == 'sha1':
-                return bytes.fromhex(self._line[1])
-            if column_name == 'md5':
-                return bytes.fromhex(self._line[2])
-            raise ValueError(f"Column `{column_name}` not supported")
+            if column_name not in ('size', 'sha1', 'md5'):
+                raise ValueError(f"Column `{column_name}` not supported")
+            return getattr(self, column_name)
 
     ################################################################################
     # file_infos
@@ -302,8 +474,10 @@ class NsrlRdsInputDatabase(BaseInputDatabase):
     def file_infos(self):
         cursor = self.connection.cursor()
         cursor.execute("SELECT DISTINCT file_size, sha1, md5 FROM FILE;")
+        # fetchmany() defaults to one row per call
+        cursor.arraysize = self.FETCH_BATCH_SIZE
         while True:
-            lines = cursor.fetchmany()
+            lines = cursor.fetchmany(self.FETCH_BATCH_SIZE)
             if len(lines) == 0:
                 return
             for line in lines:
@@ -314,6 +488,9 @@ class NsrlRdsInputDatabase(BaseInputDatabase):
 #   Import a National Software Reference Library CAID database
 ################################################################################
 class NsrlCaidInputDatabase(BaseInputDatabase):
+    # Picks just the fields this script uses out of a data line, quoted or not.
+    FIELD_PATTERN = re.compile(r'"(Category|MediaSize|SHA1|MD5)":"?([^",]*)')
+
     ################################################################################
     # __init__
     ################################################################################
@@ -341,14 +518,15 @@ class NsrlCaidInputDatabase(BaseInputDatabase):
 
     ################################################################################
     # FileInfo
-    #   This class's file_infos generated objects.
+    #   This class's file_infos generated objects, built from the fields matched
+    #   by FIELD_PATTERN.
     ################################################################################
     class FileInfo:
-        def __init__(self, line):
-            parts = [a.split(':') for a in line.split(',')]
-            self._dict = {}
-            for x in parts:
-                self._dict[x[0]] = x[1]
+        def __init__(self, fields):
+            self._dict = fields
+            self.size = int(self._dict['MediaSize'])
+            self.sha1 = bytes.fromhex(self._dict['SHA1'])
+            self.md5 = bytes.fromhex(self._dict['MD5'])
 
         @property
         def valid(self):
@@ -356,16 +534,12 @@ class NsrlCaidInputDatabase(BaseInputDatabase):
 
         @property
         def category(self):
-            return int(self._dict['"Category"'])
+            return int(self._dict['Category'])
 
         def get_column(self, column_name):
-            if column_name == 'size':
-                return int( self._dict['"MediaSize"'].strip('"') )
-            if column_name == 'sha1':
-                return bytes.fromhex( self._dict['"SHA1"'].strip('"') )
-            if column_name == 'md5':
-                return bytes.fromhex( self._dict['"MD5"'].strip('"') )
-            raise ValueError(f"Column `{column_name}` not supported")
+            if column_name not in ('size', 'sha1', 'md5'):
+                raise ValueError(f"Column `{column_name}` not supported")
+            return getattr(self, column_name)
 
     ################################################################################
     # file_infos
@@ -373,27 +547,29 @@ class NsrlCaidInputDatabase(BaseInputDatabase):
     @property
     def file_infos(self):
         DATA_LINE_HEADER = (' ' * 6) + '],'
+        find_fields = NsrlCaidInputDatabase.FIELD_PATTERN.findall
         with open(self._db_path, 'r') as file:
-            while True:
-                line = file.readline()
-                if line == "":
-                    return
+            for line in file:
                 if not line.startswith(DATA_LINE_HEADER):
                     continue
-                meat = line[len(DATA_LINE_HEADER):-1]
-                info = NsrlCaidInputDatabase.FileInfo(meat)
-                if info.valid and self.is_category_desired(info.category):
-                    yield info
+                fields = dict(find_fields(line, len(DATA_LINE_HEADER)))
+                # Filter before FileInfo so unwanted entries are never hex-decoded
+                if not self.is_category_desired(int(fields['Category'])):
+                    continue
+                yield NsrlCaidInputDatabase.FileInfo(fields)
 
 ################################################################################
 # CsvInputDatabase
 #   This csv implementation assumes the column names are exactly the ones from
 #   a OTFE-ggenerated logical imaging csv.  If this is not the case, you will
 #   need to edit at least
-#       CsvInputDatabase->FileInfo->__init__
+#       CsvInputDatabase->FIELD_NAMES
 #   to get the fields correctly for your csv.
 ################################################################################
 class CsvInputDatabase(BaseInputDatabase):
+    # Header names of the type, size, sha1 and md5 fields, in that order.
+    FIELD_NAMES = ('Type', 'Filesize', 'SHA1 Hash', 'MD5 Hash')
+
     def __init__(self, csv_path, dialect='excel'):
         super().__init__()
 
@@ -401,18 +577,52 @@ class CsvInputDatabase(BaseInputDatabase):
         self._dialect = dialect
 
         self._cols = set()
-
-        with open(self._csv_path, 'r', newline='') as f:
-            csv_reader = csv.DictReader(f, dialect=self._dialect)
-            for row_dict in csv_reader:
-                info = CsvInputDatabase.FileInfo(row_dict)
+        # (file, reader, first FileInfo) left open by the column scan below, so the
+        # first pass of file_infos carries on from it instead of re-reading.
+        self._peeked = None
+
+        f = open(self._csv_path, 'r', newline='')
+        try:
+            csv_reader = csv.reader(f, dialect=self._dialect)
+            self._field_indices = CsvInputDatabase.get_field_indices(next(csv_reader, []))
+            type_idx = self._field_indices[0]
+            for row in csv_reader:
+                if not row:
+                    continue
+                if type_idx is not None and row[type_idx] == 'Directory':
+                    continue
+                info = CsvInputDatabase.FileInfo.from_row(row, self._field_indices)
                 if info.valid:
                     self._cols = info.columns
+                    self._peeked = (f, csv_reader, info)
                     break
+        except BaseException:
+            f.close()
+            raise
         if len(self._cols) == 0:
+            f.close()
             raise ValueError(
                 "No CSV columns found.  Check that this script supports your column names")
 
+    ################################################################################
+    # __del__
+    #   Close the scanned file if file_infos never took it over.
+    ################################################################################
+    def __del__(self):
+        if self._peeked is not None:
+            self._peeked[0].close()
+
+    ################################################################################
+    # get_field_indices
+    #   Position of each of FIELD_NAMES in the header row, or None if the csv does
+    #   not have that field.  As with csv.DictReader, the last of any duplicated
+    #   names wins.
+    ################################################################################
+    @staticmethod
+    def get_field_indices(header):
+        positions = {name: i for i, name in enumerate(header)}
+        return tuple(positions.get(name) for name in CsvInputDatabase.FIELD_NAMES)
+
     ################################################################################
     # available_columns
     ################################################################################
@@ -425,11 +635,24 @@ class CsvInputDatabase(BaseInputDatabase):
     #   This class's file_infos generated objects.
     ################################################################################
     class FileInfo:
-        def __init__(self, line_dict):
-            self._valid = line_dict.get('Type', '') != 'Directory'
-            self.size = line_dict.get('Filesize', '') or None
-            self.sha1 = line_dict.get('SHA1 Hash', '') or None
-            self.md5 = line_dict.get('MD5 Hash', '') or None
+        def __init__(self, type_name, size, sha1, md5):
+            self._valid = type_name != 'Directory'
+            # Directory rows are thrown away, and their fields need not parse
+            # (e.g. a Filesize of <DIR>), so don't convert them.
+            if not self._valid:
+                self.size = self.sha1 = self.md5 = None
+                return
+            self.size = int(size) if size else None
+            self.sha1 = bytes.fromhex(sha1) if sha1 else None
+            self.md5 = bytes.fromhex(md5) if md5 else None
+
+        @classmethod
+        def from_row(cls, row, field_indices):
+            type_idx, size_idx, sha1_idx, md5_idx = field_indices
+            return cls(row[type_idx] if type_idx is not None else '',
+                       row[size_idx] if size_idx is not None else '',
+                       row[sha1_idx] if sha1_idx is not None else '',
+                       row[md5_idx] if md5_idx is not None else '')
 
         @property
         def valid(self):
@@ -438,31 +661,42 @@ class CsvInputDatabase(BaseInputDatabase):
         @property
         def columns(self):
             tr = []
-            if self.size: tr += ['size']
-            if self.sha1: tr += ['sha1']
-            if self.md5:  tr += ['md5']
+            if self.size is not None: tr += ['size']
+            if self.sha1 is not None: tr += ['sha1']
+            if self.md5 is not None:  tr += ['md5']
             return set(tr)
 
         def get_column(self, column_name):
-            if column_name == 'size':
-                return int(self.size)
-            if column_name == 'sha1':
-                return bytes.fromhex(self.sha1)
-            if column_name == 'md5':
-                return bytes.fromhex(self.md5)
-            raise ValueError(f"Column `{column_name}` not supported")
+            if column_name not in ('size', 'sha1', 'md5'):
+                raise ValueError(f"Column `{column_name}` not supported")
+            return getattr(self, column_name)
 
     ################################################################################
     # file_infos
     ################################################################################
     @property
     def file_infos(self):
-        with open(self._csv_path, 'r', newline='') as f:
-            csv_reader = csv.DictReader(f, dialect=self._dialect)
-            for row_dict in csv_reader:
-                ty = CsvInputDatabase.FileInfo(row_dict)
-                if ty.valid:
-                    yield ty
+        field_indices = self._field_indices
+        type_idx = field_indices[0]
+        if self._peeked is not None:
+            f, csv_reader, first = self._peeked
+            self._peeked = None
+        else:
+            f = open(self._csv_path, 'r', newline='')
+            csv_reader = csv.reader(f, dialect=self._dialect)
+            next(csv_reader, None)
+            first = None
+        # The first yield is inside the with too, so the file is closed however
+        # the caller stops iterating.
+        with f:
+            if first is not None:
+                yield first
+            for row in csv_reader:
+                if not row:
+                    continue
+                if type_idx is not None and row[type_idx] == 'Directory':
+                    continue
+                yield CsvInputDatabase.FileInfo.from_row(row, field_indices)
 
 ################################################################################
 # create_and_fill_header_table
@@ -482,6 +716,9 @@ def create_and_fill_header_table(input_db, output_db_cursor):
 
 ################################################################################
 # create_files_table
+#   The files table deliberately has no PRIMARY KEY or UNIQUE constraint, so no
+#   b-tree other than the table itself is maintained during the bulk insert.
+#   See create_indexes.
 ################################################################################
 def create_files_table(input_db, output_db_cursor, columns_override=None):
     columns = input_db.columns_with_type(columns_override)
@@ -490,9 +727,38 @@ def create_files_table(input_db, output_db_cursor, columns_override=None):
     columns_text = ', '.join(columns)
     output_db_cursor.execute(f"CREATE TABLE files ({columns_text});")
 
+################################################################################
+# make_row_extractor
+#   Returns a function that turns a FileInfo into the tuple of values for
+#   column_names, read straight from the FileInfo's attributes.
+################################################################################
+def make_row_extractor(column_names):
+    getter = operator.attrgetter(*column_names)
+    if len(column_names) == 1:
+        # attrgetter of a single name returns the bare value, not a tuple
+        return lambda file: (getter(file),)
+    return getter
+
+################################################################################
+# ichunks
+#   Splits any iterable into lists of at most n items, so only one chunk is
+#   ever held in memory at a time.
+################################################################################
+def ichunks(iterable, n):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
 ################################################################################
 # fill_files_table
+#   Rows are inserted FILES_INSERT_BATCH_SIZE at a time with executemany, all
+#   inside a single transaction that is committed once at the end.
 ################################################################################
+FILES_INSERT_BATCH_SIZE = 50000
+
 def fill_files_table(input_db, output_db_cursor, columns_override=None, print_status=False):
     column_names = input_db.ordered_column_subset(columns_override)
     column_names_str = ', '.join(column_names)
@@ -506,20 +772,67 @@ def fill_files_table(input_db, output_db_cursor, columns_override=None, print_st
         files_processed = 0
         print(f"Entries processed: {files_processed:,}", end='\r')
 
-    for file in input_db.file_infos:
-        values = [file.get_column(a) for a in column_names]
-        output_db_cursor.execute(insert_statement, values)
+    source = input_db.sqlite_source(column_names)
+    if source is not None:
+        files_processed = copy_files_from_sqlite(output_db_cursor, column_names, *source)
         if print_status:
-            files_processed += 1
-            current_time = time.time()
-            if current_time > next_print_time:
-                print(f"Entries processed: {files_processed:,}", end='\r')
-                next_print_time = current_time + TIME_PRINT_GRANULARITY
+            print(f"Entries processed: {files_processed:,}")
+        return
+
+    # The header insert may already have opened the transaction.
+    if not output_db_cursor.connection.in_transaction:
+        output_db_cursor.execute("BEGIN;")
+
+    # Inserting in size order keeps the later all_index build closer to sequential.
+    sort_by_size = column_names[0] == 'size'
+    rows = map(make_row_extractor(column_names), input_db.file_infos)
+    if print_status:
+        # Counted as each row is produced rather than per chunk, so slow inputs
+        # such as folder hashing still show progress between inserts.
+        def counted(rows):
+            nonlocal files_processed, next_print_time
+            for row in rows:
+                files_processed += 1
+                current_time = time.time()
+                if current_time > next_print_time:
+                    print(f"Entries processed: {files_processed:,}", end='\r')
+                    next_print_time = current_time + TIME_PRINT_GRANULARITY
+                yield row
+        rows = counted(rows)
+
+    for chunk in ichunks(rows, FILES_INSERT_BATCH_SIZE):
+        if sort_by_size:
+            chunk.sort(key=lambda row: row[0])
+        output_db_cursor.executemany(insert_statement, chunk)
+
+    output_db_cursor.connection.commit()
     if print_status:
         print(f"Entries processed: {files_processed:,}")
 
+################################################################################
+# copy_files_from_sqlite
+#   Copies rows from another SQLite database entirely inside SQLite, with no
+#   per-row Python work.  Returns the number of rows copied.
+################################################################################
+def copy_files_from_sqlite(output_db_cursor, column_names, db_path, select_statement):
+    con = output_db_cursor.connection
+    # ATTACH is not allowed inside a transaction.
+    if con.in_transaction:
+        con.commit()
+    output_db_cursor.execute("ATTACH DATABASE ? AS src;", (db_path,))
+    output_db_cursor.execute("BEGIN;")
+    column_names_str = ', '.join(column_names)
+    output_db_cursor.execute(f"INSERT INTO files ({column_names_str}) {select_statement};")
+    copied = output_db_cursor.rowcount
+    con.commit()
+    output_db_cursor.execute("DETACH DATABASE src;")
+    return copied
+
 ################################################################################
 # create_indexes
+#   Must run after fill_files_table: building the index once from the full table
+#   is far cheaper than maintaining it for every inserted row.  Statistics are
+#   gathered once the index exists.
 ################################################################################
 def create_indexes(input_db, output_db_cursor, columns_override=None):
     column_names = input_db.ordered_column_subset(columns_override)
@@ -527,25 +840,75 @@ def create_indexes(input_db, output_db_cursor, columns_override=None):
         cols = ', '.join(column_names)
         output_db_cursor.execute(f"CREATE INDEX all_index ON files ({cols});")
 
+    output_db_cursor.execute("ANALYZE;")
     output_db_cursor.execute("PRAGMA optimize;")
 
 ################################################################################
-# write_to_output_db
+# build_output_db
 ################################################################################
-def write_to_output_db(input_db, output_path, print_status=False):
-    con = sqlite3.connect(output_path)
-    cur = con.cursor()
-
-    cur.execute("PRAGMA application_id = 0x4f544844;")
-    cur.execute("PRAGMA user_version = 1;")
-
-    create_and_fill_header_table(input_db, cur)
-    create_files_table(input_db, cur)
-    fill_files_table(input_db, cur, print_status=print_status)
-
-    create_indexes(input_db, cur)
+BULK_LOAD_PRAGMAS = """
+    PRAGMA page_size = 65536;
+    PRAGMA journal_mode = OFF;
+    PRAGMA synchronous = OFF;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA locking_mode = EXCLUSIVE;
+    PRAGMA cache_size = -262144;
+"""
+
+def build_output_db(input_db, build_path, print_status=False):
+    con = sqlite3.connect(build_path)
+    try:
+        cur = con.cursor()
+
+        # Bulk-load tuning.  No journal is kept, so an interrupted build is
+        # unusable and must be started again.  page_size only takes effect if
+        # set before anything is written to the new database.
+        cur.executescript(BULK_LOAD_PRAGMAS)
+
+        cur.execute("PRAGMA application_id = 0x4f544844;")
+        cur.execute("PRAGMA user_version = 1;")
+
+        create_and_fill_header_table(input_db, cur)
+        create_files_table(input_db, cur)
+        fill_files_table(input_db, cur, print_status=print_status)
+
+        create_indexes(input_db, cur)
+    finally:
+        con.close()
 
-    con.commit()
+################################################################################
+# write_to_output_db
+#   The database is built under a temporary name in build_dir and only renamed
+#   to output_path once complete, so a failed run never leaves a partial
+#   database at output_path.  build_dir defaults to output_path's folder, making
+#   the final step just that rename; pointing it at a tmpfs such as /dev/shm
+#   keeps the build off slow disks entirely.  A build dir on another filesystem
+#   is first copied to the same temporary name next to output_path, and only
+#   that complete copy is renamed into place.
+################################################################################
+def write_to_output_db(input_db, output_path, print_status=False, build_dir=None):
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    if build_dir is None:
+        build_dir = output_dir
+    temp_name = f".{os.path.basename(output_path)}.{uuid.uuid4().hex}.tmp"
+    build_path = os.path.join(build_dir, temp_name)
+    staged_path = os.path.join(output_dir, temp_name)
+    try:
+        build_output_db(input_db, build_path, print_status=print_status)
+        try:
+            os.replace(build_path, staged_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copyfile(build_path, staged_path)
+        # os.replace would overwrite anything created there since startup.
+        if os.path.lexists(output_path):
+            raise FileExistsError(f"Output file `{output_path}` already exists")
+        os.replace(staged_path, output_path)
+    finally:
+        for path in (build_path, staged_path):
+            if os.path.exists(path):
+                os.remove(path)
 
 ################################################################################
 # __main__
@@ -571,6 +934,10 @@ if __name__ == "__main__":
                         choices=csv.list_dialects(),
                         default='excel',
                         help='CSV dialect for csv input types')
+    parser.add_argument('--build-dir',
+                        help='Folder to build the database in before moving it to output_file, '
+                             'e.g. a tmpfs such as /dev/shm (default: the folder of output_file)',
+                        default=None)
     args = parser.parse_args()
 
     if os.path.exists(args.output_file):
@@ -602,6 +969,7 @@ if __name__ == "__main__":
         input_db.name = args.name
     if len(args.description) > 0:
         input_db.description = args.description
-    write_to_output_db(input_db, args.output_file, print_status = True)
+    write_to_output_db(input_db, args.output_file, print_status = True,
+                       build_dir = args.build_dir)
     exit(0)
 
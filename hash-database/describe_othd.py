@@ -5,113 +5,209 @@
 # Copyright 2025 Opentext Corp. All Rights Reserved
 ################################################################################
 
-import uuid
+import functools
+import itertools
+import json
 import sqlite3
+import sys
+import urllib.parse
 
-import os
+################################################################################
+# open_read_only
+#   This tool never writes, so open the database read-only and immutable.  That
+#   skips journal/WAL file handling and locking entirely, the same way the
+#   logical imaging engine opens these databases.  Pages are read through a
+#   256 MiB mmap with a 16 MiB cache on top.
+#
+#   Each statement runs once per connection, so sqlite3's per-connection
+#   statement cache is turned off rather than holding prepared statements that
+#   are never reused.  The SQL text itself lives in module level constants.
+################################################################################
+READ_ONLY_PRAGMAS = """
+    PRAGMA query_only = ON;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA cache_size = -16384;
+    PRAGMA temp_store = MEMORY;
+"""
+
+def open_read_only(db_path):
+    con = sqlite3.connect(f"file:{urllib.parse.quote(db_path)}?mode=ro&immutable=1",
+                          uri=True, cached_statements=0)
+    con.executescript(READ_ONLY_PRAGMAS)
+    return con
 
 ################################################################################
 # get_header_info
+#   The header row plus the application_id and user_version metadata, all
+#   fetched in one query.
 ################################################################################
+HEADER_INFO_SQL = (
+    "SELECT h.name, h.description, h.uuid, a.application_id, v.user_version "
+    "FROM (SELECT name, description, uuid FROM header ORDER BY rowid DESC LIMIT 1) h, "
+    "pragma_application_id() a, pragma_user_version() v;")
+
 def get_header_info(db_cursor):
-    db_cursor.execute("SELECT name, description, uuid FROM header ORDER BY rowid DESC LIMIT 1;")
-    result = db_cursor.fetchall()[0]
+    db_cursor.execute(HEADER_INFO_SQL)
+    result = db_cursor.fetchone()
     return {
         'name': result[0],
         'description': result[1],
         'uuid': result[2],
+        'application_id': result[3],
+        'db_version': result[4],
     }
 
 ################################################################################
 # get_files_columns
 ################################################################################
-def get_files_columns(db_cursor):
-    db_cursor.execute("PRAGMA table_info(files);")
-    rows = db_cursor.fetchall()
-    return [ a[1] for a in rows ]
-
-################################################################################
-# get_files_index_names
-################################################################################
-def get_files_index_names(db_cursor):
-    db_cursor.execute("PRAGMA index_list(files);")
-    rows = db_cursor.fetchall()
-    return [ a[1] for a in rows ]
+FILES_COLUMNS_SQL = "SELECT name FROM pragma_table_info(?) ORDER BY cid;"
 
-################################################################################
-# get_files_index_info
-################################################################################
-def get_files_index_info(db_cursor, index_name):
-    db_cursor.execute(f"PRAGMA index_info({index_name});")
-    rows = db_cursor.fetchall()
-    return [ a[2] for a in rows ]
+def get_files_columns(db_cursor):
+    db_cursor.execute(FILES_COLUMNS_SQL, ('files',))
+    return [ a[0] for a in db_cursor ]
 
 ################################################################################
 # get_files_index_infos
+#   Every index on files with its columns in order, from a single query over
+#   the index_list/index_xinfo table-valued pragma functions.  key = 1 keeps
+#   only the indexed columns, not the rowid index_xinfo adds on the end.  Names
+#   are passed as bound parameters, never formatted into the SQL.
 ################################################################################
+FILES_INDEX_INFOS_SQL = (
+    "SELECT il.name, xi.name FROM pragma_index_list(?) il "
+    "JOIN pragma_index_xinfo(il.name) xi WHERE xi.key = 1 "
+    "ORDER BY il.seq, xi.seqno;")
+
 def get_files_index_infos(db_cursor):
-    tr = {}
-    for a in get_files_index_names(db_cursor):
-        tr[a] = get_files_index_info(db_cursor, a)
-    return tr
+    db_cursor.execute(FILES_INDEX_INFOS_SQL, ('files',))
+    return { index_name: [ a[1] for a in rows ]
+             for index_name, rows in itertools.groupby(db_cursor, key=lambda a: a[0]) }
 
 ################################################################################
 # get_files_count
+#   Always an exact count.  sqlite_stat1 would be cheaper, but it is only as
+#   current as the last ANALYZE and may only be an estimate, and these
+#   databases are often built or edited by hand.
 ################################################################################
+FILES_COUNT_SQL = "SELECT COUNT(1) from files;"
+
 def get_files_count(db_cursor):
-    db_cursor.execute("SELECT COUNT(1) from files;")
-    return db_cursor.fetchall()[0][0]
+    db_cursor.execute(FILES_COUNT_SQL)
+    return db_cursor.fetchone()[0]
 
 ################################################################################
-# get_db_application_id
+# quote_identifier
+#   Column names come from the database itself, so quote them before they go
+#   into SQL.
 ################################################################################
-def get_db_application_id(db_cursor):
-    db_cursor.execute("PRAGMA application_id;")
-    return db_cursor.fetchall()[0][0]
-
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
 
 ################################################################################
-# get_db_version
+# sample_column_sql
+#   Select expression for one column of the sample rows.  Blobs come back as
+#   lowercase hex text, anything else as is, so SQLite rather than Python
+#   decides per cell how it's shown.
 ################################################################################
-def get_db_version(db_cursor):
-    db_cursor.execute("PRAGMA user_version;")
-    return db_cursor.fetchall()[0][0]
+def sample_column_sql(name):
+    q = quote_identifier(name)
+    return f"CASE typeof({q}) WHEN 'blob' THEN lower(hex({q})) ELSE {q} END AS {q}"
 
 ################################################################################
 # HashDb
+#   Everything is read in __init__ and never changes afterwards, so the derived
+#   values below are cached_propertys, worked out at most once.
 ################################################################################
 class HashDb:
-    def __init__(self, db_path):
+    def __init__(self, db_path, optimize=False):
         self._db_path = db_path
+        self._optimize = optimize
 
-        con = sqlite3.connect(db_path)
-        cur = con.cursor()
+        # Kept open for the life of the object, so later queries reuse the pages
+        # already cached while reading the metadata below.
+        self._con = open_read_only(db_path)
+        cur = self._con.cursor()
 
         header_info = get_header_info(cur)
         self.name = header_info['name']
         self.description = header_info['description']
-        self.uuid = uuid.UUID(bytes=header_info['uuid'])
+        # uuid.UUID is only built if asked for, see the uuid property
+        self._uuid_bytes = header_info['uuid']
+        self.application_id = header_info['application_id']
+        self.db_version = header_info['db_version']
 
         self.files_columns = get_files_columns(cur)
+        # The column list as it appears in the sample SQL and header
+        self._sample_cols_sql = ','.join(map(sample_column_sql, self.files_columns))
+        self._cols_quoted = ','.join(map(quote_identifier, self.files_columns))
+        self._cols_tsv = '\t'.join(self.files_columns)
+        self._files_columns_set = frozenset(self.files_columns)
+        self._ncols = len(self.files_columns)
         self.files_index_infos = get_files_index_infos(cur)
         self.files_count = get_files_count(cur)
-
-        self.application_id = get_db_application_id(cur)
-        self.db_version = get_db_version(cur)
         cur.close()
-        con.close()
+
+    ################################################################################
+    # close
+    #   If optimize was asked for, refresh the query planner statistics stored in
+    #   the database for the logical imaging engine's lookups.  That is a write,
+    #   so it's done on a separate read-write connection once the immutable one
+    #   is closed.  0x10000 makes a fresh connection check every table rather
+    #   than only ones it has queried; SQLite before 3.46 ignores that, so an
+    #   indexed lookup like the logical imaging engine's is run first to mark
+    #   files as queried.
+    ################################################################################
+    def close(self):
+        if self._con is None:
+            return
+        self._con.close()
+        self._con = None
+        if self._optimize:
+            con = sqlite3.connect(self._db_path)
+            try:
+                first_column = quote_identifier(self.files_columns[0])
+                con.execute(f"SELECT EXISTS (SELECT 1 FROM files WHERE {first_column} = ?);",
+                            (0,)).fetchone()
+                con.execute("PRAGMA optimize=0x10002;")
+            finally:
+                con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    ################################################################################
+    # uuid
+    ################################################################################
+    @functools.cached_property
+    def uuid(self):
+        import uuid
+        return uuid.UUID(bytes=self._uuid_bytes)
+
+    ################################################################################
+    # uuid_string
+    #   The same 8-4-4-4-12 text as str(self.uuid), without building a UUID.
+    ################################################################################
+    @functools.cached_property
+    def uuid_string(self):
+        if len(self._uuid_bytes) != 16:
+            return str(self.uuid)  # lets uuid.UUID raise its usual error
+        h = self._uuid_bytes.hex()
+        return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
 
     ################################################################################
     # application_id_is_correct
     ################################################################################
-    @property
+    @functools.cached_property
     def application_id_is_correct(self):
         return self.application_id == 0x4f544844
 
     ################################################################################
     # pretty_application_id
     ################################################################################
-    @property
+    @functools.cached_property
     def pretty_application_id(self):
         if self.application_id_is_correct:
             return hex(self.application_id)
@@ -120,29 +216,25 @@ class HashDb:
     ################################################################################
     # db_version_understood_by_this_script
     ################################################################################
-    @property
+    @functools.cached_property
     def db_version_understood_by_this_script(self):
         return self.db_version == 1
 
     ################################################################################
     # has_ideal_index
     ################################################################################
-    @property
+    @functools.cached_property
     def has_ideal_index(self):
-        def index_is_ideal(index_id):
-            index = self.files_index_infos[index_id]
-            if len(index) != len(self.files_columns):
-                return False
-            if 'size' in self.files_columns:
-                return index[0] == 'size'
-            return True
-
-        return any(map(index_is_ideal, self.files_index_infos))
+        has_size = 'size' in self._files_columns_set
+        for index in self.files_index_infos.values():
+            if len(index) == self._ncols and (not has_size or index[0] == 'size'):
+                return True
+        return False
 
     ################################################################################
     # pretty_db_version
     ################################################################################
-    @property
+    @functools.cached_property
     def pretty_db_version(self):
         if self.db_version_understood_by_this_script:
             return str(self.db_version)
@@ -151,7 +243,7 @@ class HashDb:
     ################################################################################
     # pretty_name
     ################################################################################
-    @property
+    @functools.cached_property
     def pretty_name(self):
         if self.name:
             return f'"{self.name}"'
@@ -160,7 +252,7 @@ class HashDb:
     ################################################################################
     # pretty_description
     ################################################################################
-    @property
+    @functools.cached_property
     def pretty_description(self):
         if self.description:
             return f'"{self.description}"'
@@ -169,7 +261,7 @@ class HashDb:
     ################################################################################
     # pretty_has_ideal_index
     ################################################################################
-    @property
+    @functools.cached_property
     def pretty_has_ideal_index(self):
         if self.has_ideal_index:
             return "Yes"
@@ -179,37 +271,41 @@ class HashDb:
     # print_detailed_description
     ################################################################################
     def print_detailed_description(self):
-        print(f"Application Id: {self.pretty_application_id}")
-        print(f"Database Version: {self.pretty_db_version}")
-        print(f"Name: {self.pretty_name}")
-        print( "Description:")
-        print(f"    {self.pretty_description}")
-        print(f"UUID: {self.uuid}")
-        print(f"Columns: {', '.join(self.files_columns)}")
-        print(f"Has Ideal Index: {self.pretty_has_ideal_index}")
-        print( "Indexes:")
-        for a in self.files_index_infos:
-            print(f"    {a}: {', '.join(self.files_index_infos[a])}")
+        parts = [
+            f"Application Id: {self.pretty_application_id}\n",
+            f"Database Version: {self.pretty_db_version}\n",
+            f"Name: {self.pretty_name}\n",
+             "Description:\n",
+            f"    {self.pretty_description}\n",
+            f"UUID: {self.uuid}\n",
+            f"Columns: {', '.join(self.files_columns)}\n",
+            f"Has Ideal Index: {self.pretty_has_ideal_index}\n",
+             "Indexes:\n",
+        ]
+        for name, columns in self.files_index_infos.items():
+            parts.append(f"    {name}: {', '.join(columns)}\n")
         if self.files_count is not None:
-            print(f"Entries: {self.files_count:,}")
+            parts.append(f"Entries: {self.files_count:,}\n")
+        sys.stdout.writelines(parts)
+        sys.stdout.flush()
 
     ################################################################################
     # get_and_print_sample_rows
+    #   The last 20 rows, found with a reverse scan from the end of the rowid
+    #   b-tree, then printed in the order they were inserted.
     ################################################################################
     def get_and_print_sample_rows(self):
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-        print('\t'.join(self.files_columns))
-        cur.execute(f"SELECT {','.join(self.files_columns)} FROM files ORDER BY rowid DESC LIMIT 20;")
-
-        for i in cur.fetchall():
-            cols = []
-            for c in i:
-                if type(c) == bytes:
-                    cols += [str(c.hex())]
-                else:
-                    cols += [str(c)]
-            print(', '.join(cols))
+        cur = self._con.cursor()
+        cur.execute(
+            f"SELECT {self._cols_quoted} FROM "
+            f"(SELECT rowid AS sample_rowid, {self._sample_cols_sql} FROM files "
+            f"ORDER BY rowid DESC LIMIT 20) ORDER BY sample_rowid;")
+
+        lines = [self._cols_tsv]
+        lines.extend(', '.join(map(str, row)) for row in cur)
+        cur.close()
+        # One write for the whole block rather than one print per row
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
 
@@ -217,17 +313,18 @@ class HashDb:
     # print_json
     ################################################################################
     def print_json(self):
-        print("{")
-        print(f'    "application_id": {self.application_id},')
-        print(f'    "db_version": {self.db_version},')
+        tr = {
+            'application_id': self.application_id,
+            'db_version': self.db_version,
+        }
         if self.name:
-            print(f'    "name": "{self.name}",')
+            tr['name'] = self.name
         if self.description:
-            print(f'    "description": "{self.description}",')
-        print(f'    "uuid": "{self.uuid}",')
-        quoted_cols = map(lambda a : '"' + a + '"', self.files_columns)
-        print(f'    "columns": [ {", ".join(quoted_cols)} ]')
-        print("}")
+            tr['description'] = self.description
+        tr['uuid'] = self.uuid_string
+        tr['columns'] = self.files_columns
+        # json escapes quotes and backslashes in name/description properly
+        sys.stdout.write(json.dumps(tr, indent=4) + '\n')
 
 
 ################################################################################
@@ -241,18 +338,31 @@ if __name__ == "__main__":
     parser.add_argument("-j", '--json',
                         help='Print json rather than human readable',
                         action='store_true')
+    parser.add_argument('--optimize',
+                        help='Refresh the query planner statistics stored in the database '
+                             'when done (writes to the database)',
+                        action='store_true')
 
     args = parser.parse_args()
 
-    if not os.path.exists(args.db_path):
-        print(f"Database file `{args.db_path}` does not exist")
+    # No separate existence check: opening read-only fails straight away with a
+    # clear error if the file is missing or not a database.
+    try:
+        db = HashDb(args.db_path, optimize=args.optimize)
+    except sqlite3.DatabaseError as e:
+        print(f"Cannot open `{args.db_path}`: {e}")
         exit(-1)
 
-    db = HashDb(args.db_path)
-
-    if args.json:
-        db.print_json()
-    else:
-        db.print_detailed_description()
-        db.get_and_print_sample_rows()
+    # Closing writes to the database when --optimize is given, which can fail
+    # (e.g. on a read-only volume) after the output has been printed.
+    try:
+        with db:
+            if args.json:
+                db.print_json()
+            else:
+                db.print_detailed_description()
+                db.get_and_print_sample_rows()
+    except sqlite3.DatabaseError as e:
+        print(f"Cannot read or optimize `{args.db_path}`: {e}")
+        exit(-1)
     exit(0)